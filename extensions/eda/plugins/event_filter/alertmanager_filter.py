@@ -9,8 +9,27 @@ Arguments:
     * data_path_separator: The separator to interpret data_alerts_path and data_host_path.
       Defaults to ".".
     * skip_original_data: true/false. Default to false.
-      true: Only alert data will be returned as events.
-      false: Both the original event and each parsed alert will be returned as events.
+      true: Only the parsed alert events (and the original meta) are returned.
+      false: The original event is returned with the parsed alert events added.
+    * dedupe: true/false. Default to false.
+      true: Alerts already seen with the same status are skipped, so re-sent
+      firing alerts only produce an event when they are new or change status.
+    * dedupe_key: The JSON path inside the alert data that identifies an alert
+      for dedupe. Defaults to "fingerprint".
+    * dedupe_ttl: Seconds an alert is remembered for dedupe after it was last
+      received. Defaults to 43200, longer than Alertmanager's default
+      repeat_interval of 4h, so repeat notifications keep being skipped.
+    * dedupe_max_size: Maximum number of alerts remembered for dedupe, the
+      least recently received are forgotten first. Defaults to 10000.
+    * group_by_host: true/false. Default to false.
+      true: One alert event is created per host, holding every alert for that
+      host under "alerts". Alerts without host information are grouped together.
+      false: One alert event is created per alert, holding the alert under "alert".
+
+Returns:
+-------
+    A single event dict. The per-alert (or per-host) events are listed, in
+    payload order, under "alert_events".
 
 Example:
 -------
@@ -26,51 +45,179 @@ Example:
                 data_host_path: labels.instance
                 data_path_separator: .
                 skip_original_data: false
+                dedupe: true
+                dedupe_ttl: 43200
 """
 
 from __future__ import annotations
 
-from typing import Any
+from collections import OrderedDict
+from collections.abc import Mapping, Sequence
+from functools import lru_cache
+import time
+from typing import Any, Callable
 from dpath import util
 import logging
 
 LOGGER = logging.getLogger(__name__)
 
+GLOB_CHARACTERS = frozenset("*?[")
+
+
+@lru_cache(maxsize=128)
+def compile_path(path: str, separator: str) -> Callable[[Any], Any]:
+    """Return an accessor equivalent to dpath's util.get for path.
+
+    Plain paths are split once and walked directly, using list indexes where
+    the node is a list. Paths containing glob characters keep using dpath.
+    Like dpath, the accessor raises KeyError when the path does not exist.
+    """
+    if path == "/":
+        return lambda obj: obj
+
+    segments = path.lstrip(separator).split(separator)
+    if "" in segments:
+        # dpath doesn't allow empty keys, so paths like "a..b" or "a.b." never match
+        def missing(obj: Any) -> Any:
+            raise KeyError(path)
+
+        return missing
+    if any(GLOB_CHARACTERS.intersection(segment) for segment in segments):
+        return lambda obj: util.get(obj, path, separator=separator)
+
+    def get(obj: Any) -> Any:
+        for segment in segments:
+            if isinstance(obj, Mapping):
+                if segment not in obj:
+                    raise KeyError(path)
+                obj = obj[segment]
+            elif isinstance(obj, Sequence) and not isinstance(obj, (str, bytes)):
+                try:
+                    index = int(segment)
+                except ValueError:
+                    raise KeyError(path) from None
+                if not -len(obj) <= index < len(obj):
+                    raise KeyError(path)
+                obj = obj[index]
+            else:
+                raise KeyError(path)
+        return obj
+
+    return get
+
+class DedupeCache:
+    """Remember the last status of each alert for ttl seconds after it was last seen, up to max_size alerts."""
+
+    def __init__(self, ttl: float, max_size: int) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: OrderedDict[Any, tuple[Any, float]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def is_new(self, key: Any, status: Any) -> bool:
+        """Return whether the alert is unknown or changed status, remembering it."""
+        now = time.monotonic()
+        # Entries are kept in the order they were last seen, so expired ones are at the front.
+        while self.entries:
+            oldest = next(iter(self.entries.values()))
+            if oldest[1] > now:
+                break
+            self.entries.popitem(last=False)
+
+        entry = self.entries.get(key)
+        self.entries[key] = (status, now + self.ttl)
+        self.entries.move_to_end(key)
+        if entry is not None and entry[0] == status:
+            self.hits += 1
+            return False
+
+        self.misses += 1
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return True
+
+# Dedupe caches live for the life of the process, one per dedupe configuration.
+DEDUPE_CACHES: dict[tuple[str, str, float, int], DedupeCache] = {}
+
+def dedupe_stats() -> dict[tuple[str, str, float, int], dict[str, int]]:
+    """Return hit, miss and size counts of every dedupe cache.
+
+    Results are keyed like DEDUPE_CACHES, by (dedupe_key, data_path_separator,
+    dedupe_ttl, dedupe_max_size).
+    """
+    return {
+        key: {"hits": cache.hits, "misses": cache.misses, "size": len(cache.entries)}
+        for key, cache in DEDUPE_CACHES.items()
+    }
+
 def main(
     event: dict[str, Any],
     data_alerts_path: str = "alerts",
     data_host_path: str = "labels.instance",
     data_path_separator: str = ".",
     skip_original_data: bool = False,
-) -> None:
-    """Extract alert data and host information from an event."""
+    dedupe: bool = False,
+    dedupe_key: str = "fingerprint",
+    dedupe_ttl: float = 43200,
+    dedupe_max_size: int = 10000,
+    group_by_host: bool = False,
+) -> dict[str, Any]:
+    """Extract alert data and host information from an event.
+
+    The alert events are built in payload order from a single pass over the
+    alerts. Alert dicts are referenced from the original event, not copied.
+    """
     alerts = []
+    get_host = compile_path(data_host_path, data_path_separator) if data_host_path else None
+    cache = None
+    if dedupe:
+        cache_config = (dedupe_key, data_path_separator, dedupe_ttl, dedupe_max_size)
+        cache = DEDUPE_CACHES.get(cache_config)
+        if cache is None:
+            cache = DEDUPE_CACHES[cache_config] = DedupeCache(dedupe_ttl, dedupe_max_size)
+        get_key = compile_path(dedupe_key, data_path_separator)
     # If data_alerts_path is empty, treat the entire event as a single alert.
     if not data_alerts_path:
         alerts = [event]
     else:
         try:
             # Extract alerts from the event using the specified JSON path.
-            alerts = util.get(event, data_alerts_path, separator=data_path_separator)
+            alerts = compile_path(data_alerts_path, data_path_separator)(event)
             # Ensure alerts is a list, even if only one alert is found.
             if not isinstance(alerts, list):
                 alerts = [alerts]
         except (KeyError, TypeError):
             # Log an error if the specified path does not exist in the event or if the path is incorrect.
-            LOGGER.error(f"Event {event} does not contain path {data_alerts_path}")
-            process_event(event)
-            return
+            LOGGER.error("Event %s does not contain path %s", event, data_alerts_path)
+            return event
+
+    # Keep the original event unless skip_original_data is True. It is copied
+    # so the alert events, which may reference it, don't end up inside it.
+    if skip_original_data:
+        result = {"meta": event["meta"]} if "meta" in event else {}
+    else:
+        result = dict(event)
+    alert_events = result["alert_events"] = []
 
-    # Process the original event if skip_original_data is False.
-    if not skip_original_data:
-        process_event(event)
+    # Alerts grouped by host, in the order each host was first seen.
+    groups: dict[str | None, list[Any]] = {}
 
     for alert in alerts:
+        if cache is not None:
+            try:
+                # Skip alerts that were already seen with the same status.
+                if not cache.is_new(get_key(alert), alert.get("status")):
+                    continue
+            except (KeyError, TypeError, AttributeError):
+                # Alerts without a usable key can't be deduplicated and are always processed.
+                pass
+
         hosts = []
-        if data_host_path:
+        if get_host:
             try:
                 # Extract the host information from the alert using the specified JSON path.
-                host = util.get(alert, data_host_path, separator=data_path_separator)
+                host = get_host(alert)
                 # Ensure the extracted host is a string or list of strings.
                 if isinstance(host, (str, list)):
                     if isinstance(host, str):
@@ -80,20 +227,31 @@ def main(
                         hosts.extend([clean_host(h) for h in host if isinstance(h, str)])
             except (KeyError, TypeError):
                 # Log an error if the specified host path does not exist in the alert.
-                LOGGER.error(f"Alert {alert} does not contain path {data_host_path}")
+                LOGGER.error("Alert %s does not contain path %s", alert, data_host_path)
+
+        if group_by_host:
+            for host in hosts or [None]:
+                groups.setdefault(host, []).append(alert)
+            continue
 
         # Create a new event for each alert, including the extracted host information.
-        new_event = {
+        alert_events.append({
             "alert": alert,
             "meta": {
                 "hosts": hosts
             }
-        }
-        process_event(new_event)
+        })
+
+    # Create a new event for each host, including every alert for that host.
+    for host, host_alerts in groups.items():
+        alert_events.append({
+            "alerts": host_alerts,
+            "meta": {
+                "hosts": [host] if host is not None else []
+            }
+        })
 
-def process_event(event: dict[str, Any]) -> None:
-    """Process each event by printing or any other required action."""
-    print(event)
+    return result
 
 def clean_host(host: str) -> str:
     """Remove port from host string if it exists."""
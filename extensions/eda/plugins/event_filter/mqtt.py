@@ -1,13 +1,125 @@
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+import atexit
+import json
 import logging
+import threading
+import zlib
 
-def main(event: dict, mqtt_broker: str = None, mqtt_topic: str = None, mqtt_port: int = 1883) -> dict:
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CONTENT_TYPES = {
+    "str": "text/plain",
+    "json": "application/json",
+    "msgpack": "application/msgpack",
+}
+
+# Connected clients shared by every event, keyed by (broker, port, MQTT v5)
+_clients = {}
+_clients_lock = threading.Lock()
+
+# Seconds a new client waits for the broker to accept its connection
+CONNECT_TIMEOUT = 5
+
+
+def get_client(mqtt_broker: str, mqtt_port: int, v5: bool = False) -> mqtt.Client:
+    """
+    Return the client for the broker, creating it on first use.
+    The client connects from its network loop, which runs in a background
+    thread and keeps reconnecting until the broker is up. A new client waits
+    at most CONNECT_TIMEOUT seconds for its first connection, so the event
+    that created it isn't published before the connection exists.
+    """
+    key = (mqtt_broker, mqtt_port, v5)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is not None:
+            return client
+        connected = threading.Event()
+        client = mqtt.Client(protocol=mqtt.MQTTv5 if v5 else mqtt.MQTTv311)
+        client.on_connect = lambda *args: connected.set()
+        client.reconnect_delay_set(min_delay=1, max_delay=30)
+        logging.info(f"Connecting to MQTT broker at {mqtt_broker}:{mqtt_port}")
+        client.connect_async(mqtt_broker, mqtt_port)
+        client.loop_start()
+        _clients[key] = client
+
+    if not connected.wait(CONNECT_TIMEOUT):
+        logging.warning(f"MQTT broker at {mqtt_broker}:{mqtt_port} did not accept the connection within {CONNECT_TIMEOUT}s, still retrying")
+    return client
+
+
+@atexit.register
+def close_clients():
+    """Disconnect every cached client once queued messages have been sent."""
+    with _clients_lock:
+        for client in _clients.values():
+            client.disconnect()
+            client.loop_stop()
+        _clients.clear()
+
+
+def encode_payload(event: dict, encoding: str) -> bytes:
+    """Serialize the event with the requested encoding."""
+    if encoding == "json":
+        if orjson is not None:
+            return orjson.dumps(event, default=str)
+        return json.dumps(event, separators=(",", ":"), default=str).encode()
+    if encoding == "msgpack":
+        if msgpack is None:
+            raise RuntimeError("msgpack encoding requires the msgpack package")
+        return msgpack.packb(event, default=str, use_bin_type=True)
+    if encoding == "str":
+        return str(event).encode()
+    raise ValueError(f"Unknown MQTT encoding {encoding}")
+
+
+def compress_payload(payload: bytes, compression: str) -> bytes:
+    if compression == "zlib":
+        return zlib.compress(payload)
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd compression requires the zstandard package")
+        return zstandard.ZstdCompressor().compress(payload)
+    raise ValueError(f"Unknown MQTT compression {compression}")
+
+
+def main(
+    event: dict,
+    mqtt_broker: str = None,
+    mqtt_topic: str = None,
+    mqtt_port: int = 1883,
+    mqtt_encoding: str = "str",
+    mqtt_compression: str = None,
+    mqtt_compress_min_bytes: int = 1024,
+) -> dict:
     """
     Publish an event dictionary as an MQTT message to a specified topic on an MQTT broker.
     If mqtt_topic is not provided, use 'meta.endpoint' from the event as the topic.
-    If 'meta.endpoint' is null or missing, default to 'ansible'. 
-    After the message is sent, update the 'meta' key with the success or failure status.
-    
+    If 'meta.endpoint' is null or missing, default to 'ansible'.
+    After the message is queued for sending, update the 'meta' key with the success or failure status.
+
+    One connection per broker is kept open for the life of the process, so
+    publishing an event only queues the message on that connection.
+
+    Unless the default 'str' encoding is used without compression, messages
+    are published over MQTT v5 with the encoding in the content type property
+    and any compression in a 'content-encoding' user property.
+
     Parameters
     ----------
     event : dict
@@ -15,15 +127,22 @@ def main(event: dict, mqtt_broker: str = None, mqtt_topic: str = None, mqtt_port
     mqtt_broker : str, optional
         The address of the MQTT broker.
     mqtt_topic : str, optional
-        The MQTT topic to publish the event to. Defaults to 'ansible'. If not provided, 
+        The MQTT topic to publish the event to. Defaults to 'ansible'. If not provided,
         the value of event['meta']['endpoint'] is used if available.
     mqtt_port : int, optional
         The port on which the MQTT broker is running (default is 1883).
-    
+    mqtt_encoding : str, optional
+        How the event is serialized: 'str' (Python repr, the default), 'json'
+        (compact JSON, using orjson when it is installed) or 'msgpack'.
+    mqtt_compression : str, optional
+        Compress payloads with 'zlib' or 'zstd'. Not compressed by default.
+    mqtt_compress_min_bytes : int, optional
+        Only compress payloads of at least this many bytes (default is 1024).
+
     Returns
     -------
     dict
-        The original event dictionary, with an updated 'meta' key that contains the 
+        The original event dictionary, with an updated 'meta' key that contains the
         success or failure of the MQTT message operation.
 
     """
@@ -42,28 +161,35 @@ def main(event: dict, mqtt_broker: str = None, mqtt_topic: str = None, mqtt_port
             mqtt_topic = 'ansible'
 
     try:
-        # Create MQTT client
-        client = mqtt.Client()
+        payload = encode_payload(event, mqtt_encoding)
+        properties = None
+        v5 = mqtt_encoding != "str" or bool(mqtt_compression)
 
-        # Connect to the broker
-        logging.info(f"Connecting to MQTT broker at {mqtt_broker}:{mqtt_port}")
-        client.connect(mqtt_broker, mqtt_port)
+        if v5:
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.ContentType = CONTENT_TYPES[mqtt_encoding]
+            if mqtt_compression and len(payload) >= mqtt_compress_min_bytes:
+                payload = compress_payload(payload, mqtt_compression)
+                properties.UserProperty = ("content-encoding", mqtt_compression)
+            elif mqtt_encoding != "msgpack":
+                properties.PayloadFormatIndicator = 1
 
-        # Publish the event as a message to the dynamically determined topic
-        logging.info(f"Publishing event to topic {mqtt_topic}")
-        client.publish(mqtt_topic, str(event))
+        client = get_client(mqtt_broker, mqtt_port, v5)
 
-        # Disconnect after publishing
-        client.disconnect()
+        # Publish the event as a message to the dynamically determined topic
+        logging.debug(f"Publishing event to topic {mqtt_topic}")
+        result = client.publish(mqtt_topic, payload, properties=properties)
+        if result.rc != mqtt.MQTT_ERR_SUCCESS:
+            raise RuntimeError(mqtt.error_string(result.rc))
 
         # Update meta with success status
         event['meta']['mqtt_status'] = 'success'
 
     except Exception as e:
         logging.error(f"An error occurred while sending the MQTT message: {e}")
-        
+
         # Update meta with failure status and error message
         event['meta']['mqtt_status'] = 'failure'
         event['meta']['error_message'] = str(e)
 
-    return event
\ No newline at end of file
+    return event
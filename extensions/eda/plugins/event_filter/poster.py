@@ -1,15 +1,329 @@
 import requests
+from requests.adapters import HTTPAdapter
+import atexit
+import json
 import logging
+import queue
+import threading
+import time
+from typing import Optional
 
-def main(event: dict, webhook_url: str = None) -> dict:
+# Background senders, keep-alive sessions and circuit breakers shared by every
+# event, keyed by webhook URL
+_senders = {}
+_senders_lock = threading.Lock()
+_sessions = {}
+_breakers = {}
+
+_STOP = object()
+
+# Status codes worth retrying, anything else is the receiver rejecting the event
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class CircuitBreaker:
+    """
+    Track delivery failures for one webhook URL.
+
+    After failure_threshold consecutive failures the circuit opens and events
+    are not sent at all. Once reset_timeout seconds have passed a single probe
+    is let through (half-open): success closes the circuit, failure opens it
+    again. Retries are paid for from a budget that grows by retry_budget for
+    every request, so retries never add more than that fraction of load.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, webhook_url: str, failure_threshold: int, reset_timeout: float, retry_budget: float):
+        self.webhook_url = webhook_url
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.retry_budget = retry_budget
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.retry_tokens = 1.0
+        self.transitions = {}
+        self.lock = threading.Lock()
+
+    def is_open(self) -> bool:
+        """Cheap check, without taking the lock, used to skip events while open."""
+        return self.state == self.OPEN and time.monotonic() < self.opened_at + self.reset_timeout
+
+    def allow(self) -> bool:
+        """Return whether a request may be sent now, recording it against the retry budget."""
+        with self.lock:
+            if self.state == self.OPEN:
+                if time.monotonic() < self.opened_at + self.reset_timeout:
+                    return False
+                self._transition(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                if self.probing:
+                    return False
+                self.probing = True
+            self.retry_tokens = min(self.retry_tokens + self.retry_budget, 10.0)
+            return True
+
+    def allow_retry(self) -> bool:
+        with self.lock:
+            if self.state != self.CLOSED or self.retry_tokens < 1:
+                return False
+            self.retry_tokens -= 1
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.probing = False
+            if self.state != self.CLOSED:
+                self._transition(self.CLOSED)
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                self.opened_at = time.monotonic()
+                self._transition(self.OPEN)
+
+    def _transition(self, state: str):
+        key = f"{self.state}->{state}"
+        self.transitions[key] = self.transitions.get(key, 0) + 1
+        logging.warning(f"Circuit for {self.webhook_url} is now {state} ({key} {self.transitions[key]} times)")
+        self.state = state
+
+
+class Sender(threading.Thread):
+    """
+    Deliver serialized events to one webhook URL from a background thread
+    over a keep-alive session, optionally combining several events into one
+    POST body.
     """
-    Perform an HTTP POST request to the specified webhook receiver URL with the 
+
+    def __init__(
+        self,
+        webhook_url: str,
+        timeout: float,
+        queue_size: int,
+        batch_size: int,
+        batch_linger: float,
+        breaker: CircuitBreaker,
+        max_retries: int,
+        backoff: float,
+    ):
+        super().__init__(name=f"poster {webhook_url}", daemon=True)
+        self.webhook_url = webhook_url
+        self.timeout = timeout
+        self.breaker = breaker
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.batch_size = batch_size
+        self.batch_linger = batch_linger
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.session = new_session()
+        self.stats = {"queued": 0, "sent": 0, "failed": 0, "dropped": 0, "skipped": 0}
+
+    def submit(self, body: str):
+        try:
+            self.queue.put_nowait(body)
+            self.stats["queued"] += 1
+        except queue.Full:
+            self.stats["dropped"] += 1
+            logging.warning(f"Delivery queue for {self.webhook_url} is full, dropping event")
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.batch_linger
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self.deliver(batch)
+
+    def deliver(self, batch: list):
+        # A batch is sent as a JSON list, a single event as the event itself
+        body = batch[0] if self.batch_size <= 1 else "[" + ",".join(batch) + "]"
+        result = deliver(self.session, self.webhook_url, body, self.timeout, self.breaker, self.max_retries, self.backoff)
+        if result is None:
+            self.stats["skipped"] += len(batch)
+        elif result:
+            self.stats["sent"] += len(batch)
+        else:
+            self.stats["failed"] += len(batch)
+
+    def close(self, timeout: float):
+        """Send everything still queued, waiting at most timeout seconds."""
+        try:
+            self.queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self.join(timeout)
+        self.session.close()
+        logging.info(f"Delivery to {self.webhook_url}: {self.stats}, circuit transitions: {self.breaker.transitions}")
+
+
+def new_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def post(session: requests.Session, webhook_url: str, body: str, timeout: float) -> Optional[bool]:
+    """
+    POST a JSON body and log the outcome. Returns True when it was accepted,
+    False when the receiver is unavailable and the POST may be retried, and
+    None when the receiver rejected it.
+    """
+    try:
+        logging.info("POSTing event dictionary")
+        response = session.post(
+            webhook_url,
+            data=body,
+            headers={"Content-Type": "application/json"},
+            timeout=timeout,
+        )
+        response.raise_for_status()
+
+    except requests.exceptions.HTTPError as e:
+        logging.error(f"An HTTP error occurred: {e}")
+        logging.error(f"Response Text: {e.response.text}")
+        return False if e.response.status_code in RETRY_STATUS_CODES else None
+
+    except requests.exceptions.RequestException as e:
+        logging.error(f"An HTTP error occurred: {e}")
+        return False
+
+    logging.info(f"Response Status Code: {response.status_code}")
+    return True
+
+
+def deliver(
+    session: requests.Session,
+    webhook_url: str,
+    body: str,
+    timeout: float,
+    breaker: CircuitBreaker,
+    max_retries: int,
+    backoff: float,
+) -> Optional[bool]:
+    """
+    POST a JSON body through the circuit breaker, retrying with exponential
+    backoff while the retry budget allows. Returns whether it was accepted,
+    or None when the open circuit kept it from being sent.
+    """
+    if not breaker.allow():
+        return None
+
+    attempt = 0
+    while True:
+        result = post(session, webhook_url, body, timeout)
+        if result is None:
+            # The receiver is up but rejected the event, retrying won't help
+            breaker.record_success()
+            return False
+        if result:
+            breaker.record_success()
+            return True
+
+        breaker.record_failure()
+        if attempt >= max_retries or not breaker.allow_retry():
+            return False
+        time.sleep(backoff * 2 ** attempt)
+        attempt += 1
+
+
+def get_session(webhook_url: str) -> requests.Session:
+    with _senders_lock:
+        session = _sessions.get(webhook_url)
+        if session is None:
+            session = _sessions[webhook_url] = new_session()
+        return session
+
+
+def get_breaker(webhook_url: str, failure_threshold: int, reset_timeout: float, retry_budget: float) -> CircuitBreaker:
+    with _senders_lock:
+        breaker = _breakers.get(webhook_url)
+        if breaker is None:
+            breaker = _breakers[webhook_url] = CircuitBreaker(webhook_url, failure_threshold, reset_timeout, retry_budget)
+        return breaker
+
+
+def get_sender(
+    webhook_url: str,
+    timeout: float,
+    queue_size: int,
+    batch_size: int,
+    batch_linger: float,
+    breaker: CircuitBreaker,
+    max_retries: int,
+    backoff: float,
+) -> Sender:
+    with _senders_lock:
+        sender = _senders.get(webhook_url)
+        if sender is None:
+            sender = Sender(webhook_url, timeout, queue_size, batch_size, batch_linger, breaker, max_retries, backoff)
+            sender.start()
+            _senders[webhook_url] = sender
+        return sender
+
+
+@atexit.register
+def close_senders(timeout: float = 5):
+    """Flush every background sender and close every session before the interpreter exits."""
+    with _senders_lock:
+        for sender in _senders.values():
+            sender.close(timeout)
+        _senders.clear()
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def main(
+    event: dict,
+    webhook_url: str = None,
+    timeout: float = 10,
+    background: bool = True,
+    queue_size: int = 1000,
+    batch_size: int = 1,
+    batch_linger: float = 0.5,
+    max_retries: int = 2,
+    retry_budget: float = 0.2,
+    backoff: float = 0.5,
+    failure_threshold: int = 5,
+    reset_timeout: float = 30,
+) -> dict:
+    """
+    Perform an HTTP POST request to the specified webhook receiver URL with the
     event dictionary as the JSON body, log the response, and return the event.
     The dictionary is only sent if the webhook_url is provided.
 
+    By default the event is handed to a background sender that reuses a
+    keep-alive connection to the webhook receiver, so the filter returns
+    without waiting for the receiver to respond.
+
+    Each webhook_url has a circuit breaker. After failure_threshold failed
+    POSTs in a row, events pass through without being sent until
+    reset_timeout has passed and a single probe POST succeeds.
+
     THIS IS ONLY MEANT TO ASSIST IN DEV. I use this to better understand the
     event structure so that I can write rule conditions easier
-    
+
     Parameters
     ----------
     event : dict
@@ -17,7 +331,35 @@ def main(event: dict, webhook_url: str = None) -> dict:
     webhook_url : str, optional
         The URL of the webhook receiver. If not provided, the event is not sent
         and is simply returned.
-    
+    timeout : float, optional
+        Seconds to wait for the webhook receiver to respond (default is 10).
+    background : bool, optional
+        Deliver the event from a background thread (default is True). When
+        False, the filter waits for the webhook receiver to respond.
+    queue_size : int, optional
+        Maximum number of events waiting for background delivery per
+        webhook_url. Events are dropped while the queue is full (default is 1000).
+    batch_size : int, optional
+        Maximum number of events combined into one POST body as a JSON list.
+        The default of 1 sends every event on its own.
+    batch_linger : float, optional
+        Seconds to wait for more events before sending an incomplete batch
+        (default is 0.5).
+    max_retries : int, optional
+        Maximum number of times a failed POST is retried (default is 2). Only
+        connection errors, timeouts and 429/5xx responses are retried.
+    retry_budget : float, optional
+        Retries earned per POST, limiting retries to this fraction of the
+        POSTs sent to webhook_url (default is 0.2).
+    backoff : float, optional
+        Seconds to wait before the first retry, doubled for every further
+        retry (default is 0.5).
+    failure_threshold : int, optional
+        Consecutive failed POSTs that open the circuit (default is 5).
+    reset_timeout : float, optional
+        Seconds the circuit stays open before a probe POST is let through
+        (default is 30).
+
     Returns
     -------
     dict
@@ -35,28 +377,27 @@ def main(event: dict, webhook_url: str = None) -> dict:
          filters:
            - cloin.eda.poster:
                webhook_url: https://webhook.site/asdfa2q3423-sadf-449231-asd-88f81e0asdf65d33
-            
+               batch_size: 20
+
     """
     if not webhook_url:
         logging.info("Webhook URL not defined. The event dictionary will not be sent.")
         return event
 
+    breaker = _breakers.get(webhook_url) or get_breaker(webhook_url, failure_threshold, reset_timeout, retry_budget)
+    if breaker.is_open():
+        return event
+
     try:
-        logging.info("POSTing event dictionary")
-        response = requests.post(webhook_url, json=event)
-        response.raise_for_status()
+        # Serialize now so later filters changing the event don't change what is sent
+        body = json.dumps(event, default=str)
 
-    except requests.exceptions.RequestException as e:
-        logging.error(f"An HTTP error occurred: {e}")
-        if response:
-            logging.error(f"Response Text: {response.text}")
-        return event
+        if background:
+            get_sender(webhook_url, timeout, queue_size, batch_size, batch_linger, breaker, max_retries, backoff).submit(body)
+        else:
+            deliver(get_session(webhook_url), webhook_url, body, timeout, breaker, max_retries, backoff)
 
     except Exception as e:
         logging.error(f"An error occurred: {e}")
-        return event
-
-    else:
-        logging.info(f"Response Status Code: {response.status_code}")
 
     return event
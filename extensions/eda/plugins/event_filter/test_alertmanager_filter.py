@@ -0,0 +1,84 @@
+"""Checks that compile_path resolves paths exactly like dpath's util.get."""
+
+from __future__ import annotations
+
+import os
+import sys
+
+import pytest
+from dpath import util
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from alertmanager_filter import compile_path  # noqa: E402
+
+ALERT = {
+    "status": "firing",
+    "labels": {"instance": "host1:9100", "job": "node", "a.b": "dotted"},
+    "annotations": {"summary": "down"},
+    "hosts": ["host1", "host2", "host3"],
+    "nested": [{"name": "first"}, {"name": "second", "tags": ["x", "y"]}],
+    "fingerprint": "abc123",
+}
+
+PATHS = [
+    "/",
+    "status",
+    "labels",
+    "labels.instance",
+    ".labels.instance",
+    "..labels.instance",
+    "labels.missing",
+    "missing",
+    "status.instance",
+    "hosts.0",
+    "hosts.2",
+    "hosts.3",
+    "hosts.-1",
+    "hosts.-3",
+    "hosts.-4",
+    "hosts.x",
+    "nested.1.name",
+    "nested.1.tags.0",
+    "nested.0.tags",
+    "labels..instance",
+    "labels.instance.",
+    "labels.",
+    "*.instance",
+    "labels.inst*",
+    "nested.*.tags",
+]
+
+
+def dpath_get(obj, path, separator):
+    try:
+        return "value", util.get(obj, path, separator=separator)
+    except KeyError:
+        return "missing", None
+
+
+def compiled_get(obj, path, separator):
+    try:
+        return "value", compile_path(path, separator)(obj)
+    except KeyError:
+        return "missing", None
+
+
+@pytest.mark.parametrize("path", PATHS)
+def test_compile_path_matches_dpath(path):
+    assert compiled_get(ALERT, path, ".") == dpath_get(ALERT, path, ".")
+
+
+@pytest.mark.parametrize("path", ["labels/instance", "/labels/instance", "hosts/-1", "labels//instance", "labels/"])
+def test_compile_path_matches_dpath_with_other_separator(path):
+    assert compiled_get(ALERT, path, "/") == dpath_get(ALERT, path, "/")
+
+
+@pytest.mark.parametrize("path", ["labels..instance", "labels.", "labels.instance."])
+def test_compile_path_rejects_empty_segments(path):
+    # dpath refuses empty keys, even where the data has one
+    alert = {"labels": {"": {"instance": "host1"}, "instance": {"": "host1"}}}
+    with pytest.raises(Exception):
+        util.get(alert, path, separator=".")
+    with pytest.raises(KeyError):
+        compile_path(path, ".")(alert)
@@ -1,52 +1,173 @@
 import logging
+import re
+from collections import Counter
+from functools import lru_cache
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-def main(event: dict) -> dict:
+# Events routed per route, keyed by "<match>:<endpoint>", "default" or "unrouted"
+ROUTE_COUNTS = Counter()
+
+
+class RoutingTable:
+    """
+    Endpoint to namespace routes compiled once: exact endpoints in a dict,
+    prefixes longest first and all regular expressions combined into one.
+    """
+
+    def __init__(self, routes: tuple):
+        self.exact = {}
+        self.prefixes = []
+        self.regexes = []
+        for endpoint, match, namespace in routes:
+            target = (f"{match}:{endpoint}", namespace)
+            if match == 'exact':
+                self.exact.setdefault(endpoint, target)
+            elif match == 'prefix':
+                self.prefixes.append((endpoint, target))
+            elif match == 'regex':
+                try:
+                    self.regexes.append((re.compile(endpoint), target))
+                except re.error as e:
+                    raise ValueError(f"Invalid regex route {endpoint!r}: {e}") from None
+            else:
+                raise ValueError(f"Unknown route match type: {match}")
+
+        self.prefixes.sort(key=lambda prefix: len(prefix[0]), reverse=True)
+        # One named group per regex route, so a single search finds the first matching route.
+        # Routes that can't be combined, such as ones reusing a group name, are tried one by one.
+        self.regex = None
+        if self.regexes:
+            try:
+                self.regex = re.compile("|".join(f"(?P<r{i}>{pattern.pattern})" for i, (pattern, _) in enumerate(self.regexes)))
+            except re.error:
+                logger.debug("Regex routes can't be combined, trying them one by one")
+
+    def route(self, endpoint: str):
+        """Return (route name, namespace) for endpoint, or None if no route matches."""
+        target = self.exact.get(endpoint)
+        if target:
+            return target
+        for prefix, target in self.prefixes:
+            if endpoint.startswith(prefix):
+                return target
+        if self.regex:
+            found = self.regex.fullmatch(endpoint)
+            if found:
+                return self.regexes[int(found.lastgroup[1:])][1]
+        else:
+            for pattern, target in self.regexes:
+                if pattern.fullmatch(endpoint):
+                    return target
+        return None
+
+
+@lru_cache(maxsize=32)
+def compile_routes(routes: tuple) -> RoutingTable:
+    return RoutingTable(routes)
+
+
+def get_table(routes: list) -> RoutingTable:
+    """Return the routing table for routes, compiled once per distinct set of routes."""
+    return compile_routes(tuple(
+        (route['endpoint'], route.get('match', 'exact'), route.get('namespace') or None)
+        for route in routes
+    ))
+
+
+def main(event: dict, routes: list = None, default_namespace: str = None) -> dict:
     """
     Take the value of event['meta']['endpoint'] and create a new namespace for the event.
     Both the event payload and all the meta information will be moved under this new namespace if the endpoint is specified.
 
     For example:
-    If the event is received on the "testing" endpoint, everything including 
+    If the event is received on the "testing" endpoint, everything including
     the event payload and all meta information should be accessible under event['testing'].
 
-    If the endpoint isn't specified, it returns the original event.
+    If routes are given, the endpoint is looked up in them instead and the
+    event is moved under the namespace of the first matching route.
+
+    If the endpoint isn't specified, or doesn't match any route and there is
+    no default namespace, it returns the original event.
 
     Parameters
     ----------
     event : dict
         The dictionary containing the event data.
+    routes : list, optional
+        Routes mapping endpoints to namespaces. Each route is a dict with
+        'endpoint', an optional 'match' ('exact' by default, 'prefix' or
+        'regex', which must match the whole endpoint) and an optional
+        'namespace' (the endpoint itself by default). Exact routes are tried
+        first, then prefixes, longest first, then regular expressions in order.
+        An unknown match type or invalid regular expression raises ValueError.
+    default_namespace : str, optional
+        Namespace for events whose endpoint doesn't match any route.
 
     Returns
     -------
     dict
         The modified event dictionary with the new namespace based on the endpoint, or the original event if no endpoint is specified.
+
+    Rulebook example
+    ----------------
+
+    - name: Route webhook endpoints
+      hosts: localhost
+      sources:
+        - ansible.eda.webhook:
+            host: 0.0.0.0
+            port: 5000
+          filters:
+            - cloin.eda.webhook_endpoint_as_namespace:
+                default_namespace: other
+                routes:
+                  - endpoint: alertmanager
+                  - endpoint: github/
+                    match: prefix
+                    namespace: github
+                  - endpoint: "servicenow-(incident|change)"
+                    match: regex
+                    namespace: servicenow
     """
+    # Invalid routes are a configuration error, so they aren't hidden below
+    table = get_table(routes) if routes else None
+
     try:
         logger.debug("Starting filter process...")
 
         # Extract endpoint from the event meta
         endpoint = event['meta'].get('endpoint')
-        
+
         if not endpoint:
             logger.warning("Endpoint not found. Returning the original event.")
             return event
 
-        logger.debug(f"Extracted endpoint: {endpoint}")
+        logger.debug("Extracted endpoint: %s", endpoint)
 
-        # Create a new namespace using the endpoint and move both the payload and 
+        if table:
+            target = table.route(endpoint)
+            if target is None:
+                target = ("default", default_namespace) if default_namespace else ("unrouted", None)
+            route_name, namespace = target
+            ROUTE_COUNTS[route_name] += 1
+            if route_name == "unrouted":
+                logger.debug("No route for endpoint %s. Returning the original event.", endpoint)
+                return event
+            namespace = namespace or endpoint
+        else:
+            namespace = endpoint
+
+        # Create a new namespace and move both the payload and
         # all meta information to this new namespace
         event = {
-            endpoint: event
+            namespace: event
         }
 
-        logger.debug(f"Modified event: {event}")
+        logger.debug("Moved event under namespace %s", namespace)
 
     except Exception as e:
-        logger.error(f"An error occurred: {e}")
+        logger.error("An error occurred: %s", e)
         return event
-    
+
     return event
@@ -6,6 +6,7 @@ description:
     - Poll Elasticsearch API for matching log lines
     - Retrieves matching log lines based on query
     - Log lines are then placed on the queue for evaluation by ansible rulebooks to execute an action based on matching condition
+    - In aggregation mode, matching log lines are counted by Elasticsearch and one summary event is placed on the queue per time bucket instead
 author: "Colin McNaughton (@cloin)"
 options:
     elastic_host:
@@ -34,11 +35,96 @@ options:
         description:
             - Query (as yaml dict) to be used to return matching log lines
         required: true
+    mode:
+        description:
+            - C(hits) places every matching log line on the queue. C(aggregation) places one summary event per time bucket with its count, top keys and first and last timestamps
+        required: false
+        default: hits
+        choices: ["hits", "aggregation"]
+    bucket_interval:
+        description:
+            - Width in seconds of each time bucket in aggregation mode
+        required: false
+        default: 60
+    terms_field:
+        description:
+            - Keyword field whose most frequent values are reported as top keys in aggregation mode
+        required: false
+    top_size:
+        description:
+            - Number of top keys reported per bucket in aggregation mode
+        required: false
+        default: 5
+    min_count:
+        description:
+            - Minimum number of matching log lines a bucket needs before it is placed on the queue in aggregation mode
+        required: false
+        default: 1
+    settle_delay:
+        description:
+            - Seconds to wait after a bucket ends before it is counted in aggregation mode, so log lines still being shipped and indexed are included
+        required: false
+        default: 10
+    source_includes:
+        description:
+            - List of fields (wildcards allowed) to return from each log line's _source. All fields are returned when not set
+        required: false
+    source_excludes:
+        description:
+            - List of fields (wildcards allowed) to leave out of each log line's _source
+        required: false
+    docvalue_fields:
+        description:
+            - List of fields to read from doc values instead of _source. Values are merged into the event under the same dotted path
+        required: false
+    filter_path:
+        description:
+            - List of response paths to keep, trimming the rest of the response server-side. The _id and sort of each hit are always kept
+        required: false
+        default: ["pit_id", "hits.hits._id", "hits.hits._source", "hits.hits.sort", "hits.hits.fields"]
+    slices:
+        description:
+            - Number of concurrent readers, each owning one slice of the matching log lines with its own cursor
+        required: false
+        default: 1
+    slice_field:
+        description:
+            - Numeric field whose value is hashed to assign log lines to slices. When not set, log lines are sliced by shard, in which case slices should not exceed the number of shards
+        required: false
+    max_concurrency:
+        description:
+            - Maximum number of page requests to Elasticsearch at the same time across all slices. Slices take turns page by page. Defaults to the number of slices
+        required: false
+    lag_report_interval:
+        description:
+            - Seconds between log messages reporting how far behind each slice's cursor is. Use 0 to disable
+        required: false
+        default: 60
+    timestamp_field:
+        description:
+            - Date field used to order log lines and to track which log lines have already been read
+        required: false
+        default: "@timestamp"
     interval:
         description:
-            - Seconds to wait before performing another query
+            - Seconds to wait before performing another query once all matching log lines have been read
         required: false
         default: 5
+    page_size:
+        description:
+            - Number of log lines to request per page while draining matching log lines
+        required: false
+        default: 1000
+    max_pages:
+        description:
+            - Maximum number of pages to read in a single cycle. A cycle that stops early keeps its point-in-time and position for the next cycle, which starts right away. Use 0 to read until caught up
+        required: false
+        default: 0
+    keep_alive:
+        description:
+            - How long Elasticsearch should keep the point-in-time used to page through matching log lines
+        required: false
+        default: 1m
 notes:
     - This is currently only capable of basic authentication and is used so far only for demo purposes
 '''
@@ -56,16 +142,244 @@ EXAMPLES = r'''
         query: |
         term:
             container.name.keyword: nginx
+        source_includes:
+          - "@timestamp"
+          - ecs
+          - nginx.log_level
         interval: 5
+        page_size: 1000
+        max_pages: 0
+        slices: 4
+        max_concurrency: 2
+
+- name: Elastic error storms
+  hosts: localhost
+  sources:
+    - cloin.eda.elastic:
+        elastic_host: elasticsearch
+        elastic_port: 9200
+        elastic_username: elastic
+        elastic_password: elastic!
+        elastic_index_pattern: filebeat-*
+        query: |
+          term:
+            nginx.log_level: error
+        mode: aggregation
+        bucket_interval: 60
+        terms_field: host.name
+        min_count: 100
+        interval: 15
 '''
 
 import asyncio
-from datetime import datetime
+import logging
+import time
 from elasticsearch import AsyncElasticsearch
-from dateutil.parser import parse
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional
 import yaml
 
+logger = logging.getLogger(__name__)
+
+class Cursor:
+    """Position of the last read log line, kept as the raw sort values of its hit.
+
+    The first sort value is the timestamp in epoch millis as returned by
+    Elasticsearch, so no timestamp ever needs to be parsed client side. The
+    ids of hits sharing that timestamp are remembered so the boundary can be
+    queried again without emitting duplicates.
+
+    While the reader is behind, the point-in-time it pages through is kept
+    open across cycles, as the _shard_doc tiebreaker in sort is only valid
+    inside that point-in-time.
+    """
+
+    def __init__(self, timestamp_millis: int):
+        self.sort: List[Any] = [timestamp_millis]
+        self.seen_ids = set()
+        self.pit_id: Optional[str] = None
+
+    @property
+    def timestamp(self) -> int:
+        return self.sort[0]
+
+    def range_filter(self, timestamp_field: str) -> Dict[str, Any]:
+        return {"range": {timestamp_field: {"gte": self.timestamp, "format": "epoch_millis"}}}
+
+    def advance(self, hit: Dict[str, Any]) -> bool:
+        """Move the cursor to hit and return whether hit has not been read before."""
+        sort = hit["sort"]
+        if sort[0] != self.timestamp:
+            self.seen_ids.clear()
+        self.sort = sort
+        if hit["_id"] in self.seen_ids:
+            return False
+        self.seen_ids.add(hit["_id"])
+        return True
+
+
+DEFAULT_FILTER_PATH = ["pit_id", "hits.hits._id", "hits.hits._source", "hits.hits.sort", "hits.hits.fields"]
+REQUIRED_FILTER_PATH = ["pit_id", "hits.hits._id", "hits.hits.sort"]
+
+
+def build_event(hit: Dict[str, Any]) -> Dict[str, Any]:
+    """Return the log line for hit, with any doc value fields nested by their dotted path."""
+    event = hit.get("_source", {})
+    for name, values in hit.get("fields", {}).items():
+        *parents, leaf = name.split(".")
+        node = event
+        for key in parents:
+            node = node.setdefault(key, {})
+        node[leaf] = values[0] if len(values) == 1 else values
+    return event
+
+
+async def close_pit(es: AsyncElasticsearch, cursor: Cursor):
+    """Close the cursor's point-in-time, which expires on its own if closing fails."""
+    pit_id, cursor.pit_id = cursor.pit_id, None
+    try:
+        await es.close_point_in_time(id=pit_id)
+    except Exception as e:
+        logger.debug("Could not close point-in-time: %s", e)
+
+
+async def drain(
+    es: AsyncElasticsearch,
+    queue: asyncio.Queue,
+    index: str,
+    query: Dict[str, Any],
+    timestamp_field: str,
+    cursor: Cursor,
+    page_size: int,
+    max_pages: int,
+    keep_alive: str,
+    search_options: Dict[str, Any],
+    semaphore: asyncio.Semaphore,
+) -> bool:
+    """Page through all log lines at or after cursor using a point-in-time.
+
+    Returns whether the result set was exhausted. Otherwise the
+    point-in-time is left open so the next call carries on where this one
+    stopped. semaphore is held for each page request only, so readers that
+    share it take turns page by page.
+    """
+    sort = [
+        {timestamp_field: {"order": "asc"}},
+        {"_shard_doc": {"order": "asc"}},
+    ]
+    bounded_query = {
+        "bool": {
+            "must": [query],
+            "filter": [cursor.range_filter(timestamp_field)],
+        }
+    }
+    # The _shard_doc tiebreaker is only meaningful inside the point-in-time it
+    # came from, so the first page of a new one is bounded by the range filter alone.
+    if cursor.pit_id is None:
+        pit = await es.open_point_in_time(index=index, keep_alive=keep_alive)
+        cursor.pit_id = pit["id"]
+        search_after: Optional[List[Any]] = None
+    else:
+        search_after = cursor.sort
+    pages = 0
+
+    try:
+        while True:
+            async with semaphore:
+                response = await es.search(
+                    pit={"id": cursor.pit_id, "keep_alive": keep_alive},
+                    query=bounded_query,
+                    sort=sort,
+                    search_after=search_after,
+                    size=page_size,
+                    track_total_hits=False,
+                    **search_options,
+                )
+            # filter_path drops empty keys, so an exhausted page may have no hits at all
+            body = response.body
+            cursor.pit_id = body.get("pit_id", cursor.pit_id)
+            hits = body.get("hits", {}).get("hits", [])
+
+            for hit in hits:
+                if cursor.advance(hit):
+                    await queue.put(build_event(hit))
+
+            pages += 1
+            if len(hits) < page_size:
+                break
+            if max_pages and pages >= max_pages:
+                return False
+            search_after = cursor.sort
+    except BaseException:
+        # Start over from the cursor's timestamp in a new point-in-time
+        await close_pit(es, cursor)
+        raise
+
+    await close_pit(es, cursor)
+    return True
+
+
+async def aggregate(
+    es: AsyncElasticsearch,
+    queue: asyncio.Queue,
+    index: str,
+    query: Dict[str, Any],
+    timestamp_field: str,
+    start: int,
+    end: int,
+    bucket_interval: int,
+    terms_field: Optional[str],
+    top_size: int,
+    min_count: int,
+):
+    """Count log lines between start and end (epoch millis) per time bucket.
+
+    end must fall on a bucket boundary so only complete buckets are reported.
+    """
+    bucket_aggs = {
+        "first": {"min": {"field": timestamp_field}},
+        "last": {"max": {"field": timestamp_field}},
+    }
+    if terms_field:
+        bucket_aggs["top_keys"] = {"terms": {"field": terms_field, "size": top_size}}
+
+    response = await es.search(
+        index=index,
+        query={
+            "bool": {
+                "must": [query],
+                "filter": [{"range": {timestamp_field: {"gte": start, "lt": end, "format": "epoch_millis"}}}],
+            }
+        },
+        aggs={
+            "buckets": {
+                "date_histogram": {
+                    "field": timestamp_field,
+                    "fixed_interval": f"{bucket_interval}s",
+                    "min_doc_count": max(min_count, 1),
+                },
+                "aggs": bucket_aggs,
+            }
+        },
+        size=0,
+        track_total_hits=False,
+        filter_path=["aggregations.buckets.buckets"],
+    )
+
+    buckets = response.body.get("aggregations", {}).get("buckets", {}).get("buckets", [])
+    for bucket in buckets:
+        await queue.put({
+            "bucket": bucket["key_as_string"],
+            "bucket_interval": bucket_interval,
+            "count": bucket["doc_count"],
+            "top_keys": [
+                {"key": term["key"], "count": term["doc_count"]}
+                for term in bucket.get("top_keys", {}).get("buckets", [])
+            ],
+            "first_timestamp": bucket["first"].get("value_as_string"),
+            "last_timestamp": bucket["last"].get("value_as_string"),
+            "index_pattern": index,
+        })
+
 
 async def main(queue: asyncio.Queue, args: Dict[str, Any]):
     elastic_host = args.get("elastic_host", "localhost")
@@ -75,41 +389,116 @@ async def main(queue: asyncio.Queue, args: Dict[str, Any]):
     elastic_index_pattern = args.get("elastic_index_pattern", "filebeat-*")
     interval = args.get("interval", 5)
     query = args.get("query", "term:\n  container.name.keyword: nginx")
+    timestamp_field = args.get("timestamp_field", "@timestamp")
+    page_size = int(args.get("page_size", 1000))
+    max_pages = int(args.get("max_pages", 0))
+    keep_alive = args.get("keep_alive", "1m")
+    source_includes = args.get("source_includes")
+    source_excludes = args.get("source_excludes")
+    docvalue_fields = args.get("docvalue_fields")
+    filter_path = args.get("filter_path") or DEFAULT_FILTER_PATH
+    slices = int(args.get("slices", 1))
+    slice_field = args.get("slice_field")
+    max_concurrency = int(args.get("max_concurrency") or slices)
+    lag_report_interval = int(args.get("lag_report_interval", 60))
+    mode = args.get("mode", "hits")
+    bucket_interval = int(args.get("bucket_interval", 60))
+    terms_field = args.get("terms_field")
+    top_size = int(args.get("top_size", 5))
+    min_count = int(args.get("min_count", 1))
+    settle_delay = float(args.get("settle_delay", 10))
 
     elastic_query = yaml.safe_load(query)
 
+    # Only ask for the parts of each log line and of the response that are used
+    projection = {
+        "filter_path": list(dict.fromkeys(REQUIRED_FILTER_PATH + list(filter_path))),
+    }
+    if source_includes:
+        projection["source_includes"] = source_includes
+    if source_excludes:
+        projection["source_excludes"] = source_excludes
+    if docvalue_fields:
+        projection["docvalue_fields"] = docvalue_fields
+
+    # Start every slice reading from the current timestamp
+    start = int(time.time() * 1000)
+    cursors = [Cursor(start) for _ in range(slices)]
+    caught_up_at = [time.time()] * slices
+    semaphore = asyncio.Semaphore(max_concurrency)
+
     async with AsyncElasticsearch(f"http://{elastic_host}:{elastic_port}", basic_auth=(elastic_username, elastic_password)) as es:
-        # Set the initial search_after value to the current timestamp
-        search_after = datetime.utcnow()
 
-        while True:
-            sort = [
-                {
-                    "@timestamp": {
-                        "order": "asc"
-                    }
-                }
-            ]
-
-            # Run the query
-            response = await es.search(
-                index=elastic_index_pattern,
-                query=elastic_query,
-                sort=sort,
-                search_after=[search_after.isoformat()],
-                size=1000
-            )
-
-            # Process the results
-            for hit in response['hits']['hits']:
-                log_entry = hit["_source"]
-                await queue.put(log_entry)
-
-                # Update the search_after value to the current log entry's timestamp
-                search_after = parse(log_entry["@timestamp"])
-
-            # Wait before running the query again
-            await asyncio.sleep(interval)
+        if mode == "aggregation":
+            # Only report buckets that have fully elapsed since startup
+            bucket_millis = bucket_interval * 1000
+            bucket_start = start // bucket_millis * bucket_millis
+
+            while True:
+                # Leave log lines time to be shipped and indexed before counting their bucket
+                settled = int((time.time() - settle_delay) * 1000)
+                bucket_end = settled // bucket_millis * bucket_millis
+                if bucket_end > bucket_start:
+                    await aggregate(
+                        es,
+                        queue,
+                        elastic_index_pattern,
+                        elastic_query,
+                        timestamp_field,
+                        bucket_start,
+                        bucket_end,
+                        bucket_interval,
+                        terms_field,
+                        top_size,
+                        min_count,
+                    )
+                    bucket_start = bucket_end
+                await asyncio.sleep(interval)
+
+        async def read_slice(slice_id: int):
+            search_options = dict(projection)
+            if slices > 1:
+                search_options["slice"] = {"id": slice_id, "max": slices}
+                if slice_field:
+                    search_options["slice"]["field"] = slice_field
+
+            while True:
+                caught_up = await drain(
+                    es,
+                    queue,
+                    elastic_index_pattern,
+                    elastic_query,
+                    timestamp_field,
+                    cursors[slice_id],
+                    page_size,
+                    max_pages,
+                    keep_alive,
+                    search_options,
+                    semaphore,
+                )
+
+                # Only wait once every matching log line in this slice has been read
+                if caught_up:
+                    caught_up_at[slice_id] = time.time()
+                    await asyncio.sleep(interval)
+
+        async def report_lag():
+            while True:
+                await asyncio.sleep(lag_report_interval)
+                now = time.time()
+                for slice_id, cursor in enumerate(cursors):
+                    logger.info(
+                        "Slice %d/%d last caught up %.1fs ago, cursor at %.1fs old",
+                        slice_id,
+                        slices,
+                        now - caught_up_at[slice_id],
+                        now - cursor.timestamp / 1000,
+                    )
+
+        tasks = [read_slice(slice_id) for slice_id in range(slices)]
+        if lag_report_interval:
+            tasks.append(report_lag())
+        await asyncio.gather(*tasks)
 
 
 if __name__ == "__main__":
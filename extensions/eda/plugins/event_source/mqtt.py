@@ -1,4 +1,3 @@
-
 DOCUMENTATION = r'''
 module: mqtt
 short_description: event-driven-ansible source plugin for mqtt
@@ -13,8 +12,68 @@ options:
         required: true
     topic:
         description:
-            - Topic to subscribe to for events
-        required: true
+            - Topic to subscribe to for events. All subtopics (C(topic/#)) are subscribed
+        required: false
+    qos:
+        description:
+            - QoS used to subscribe to C(topic)
+        required: false
+        default: 0
+    topics:
+        description:
+            - List of topic filters to subscribe to over the same connection, in addition to C(topic)
+            - Each item is either a topic filter or a dictionary with a C(topic) key and an optional C(qos) key
+        required: false
+        type: list
+    shared_group:
+        description:
+            - Subscribe with C($share/<shared_group>/) so that every rulebook using the same group receives a share of the messages instead of all of them
+        required: false
+    protocol_version:
+        description:
+            - MQTT protocol version to connect with. Defaults to C(5) when C(shared_group) is set and C(3.1.1) otherwise
+        required: false
+        choices: ["3.1", "3.1.1", "5"]
+    payload_format:
+        description:
+            - C(raw) places each payload on the queue as a string. C(json) parses each payload and places a dictionary with C(payload) and C(meta) (topic, qos and retain flag) on the queue
+            - JSON is parsed with orjson when it is installed and with the standard library otherwise
+        required: false
+        default: raw
+        choices: ["raw", "json"]
+    forward_parse_errors:
+        description:
+            - When true, payloads that are not valid UTF-8 or cannot be parsed are placed on the queue with a C(parse_error) key instead of only being counted and logged
+        required: false
+        default: false
+    buffer_size:
+        description:
+            - Maximum number of received messages held between the MQTT connection and the rulebook queue while ansible-rulebook is catching up
+        required: false
+        default: 10000
+    overflow_policy:
+        description:
+            - What to do with a received message while the buffer is full
+            - C(block) stops reading from the broker until there is room, C(drop_oldest) discards the oldest buffered message, C(drop_newest) discards the received message
+            - C(coalesce) replaces the latest buffered message on the same topic with the received message, or discards the oldest buffered message when none is on that topic
+        required: false
+        default: block
+        choices: ["block", "drop_oldest", "drop_newest", "coalesce"]
+    max_batch:
+        description:
+            - Maximum number of messages placed on the queue as a single event. Each event then holds a C(batch) list with the topic, qos, retain flag and payload of every message. Use 1 to place every message on the queue on its own
+        required: false
+        default: 1
+    linger_ms:
+        description:
+            - Milliseconds to wait for more messages before placing an incomplete batch on the queue
+        required: false
+        default: 100
+    stats_interval:
+        description:
+            - Seconds between log messages reporting message, parse error, dropped and coalesced counts and the batch size and latency distributions. Use 0 to disable
+        required: false
+        default: 60
 notes:
     - This is currently only capable of basic authentication and is used so far only for demo purposes
 '''
@@ -32,25 +91,303 @@ EXAMPLES = r'''
           condition: event.type is defined
           action:
             debug:
+
+    - name: Telemetry batches
+      hosts: localhost
+      sources:
+        - cloin.eda.mqtt:
+            host: localhost
+            topic: telemetry
+            payload_format: json
+            overflow_policy: coalesce
+            max_batch: 500
+            linger_ms: 250
+
+      rules:
+        - name: New telemetry batch
+          condition: event.batch is defined
+          action:
+            debug:
+
+    - name: Sensor events shared across rulebooks
+      hosts: localhost
+      sources:
+        - cloin.eda.mqtt:
+            host: localhost
+            shared_group: eda
+            topics:
+              - topic: sensors/+/temperature
+                qos: 1
+              - sensors/+/humidity
+
+      rules:
+        - name: New sensor event
+          condition: event is defined
+          action:
+            debug:
 '''
 
 import asyncio
+import json
 import logging
 import os
-from typing import Any, Dict
+from collections import Counter, deque
+from typing import Any, Dict, List, Optional, Tuple
+
+from asyncio_mqtt import Client, ProtocolVersion
+
+try:
+    import orjson
+    json_loads = orjson.loads
+    JSON_BACKEND = "orjson"
+except ImportError:
+    json_loads = json.loads
+    JSON_BACKEND = "json"
+
+logger = logging.getLogger(__name__)
+
+
+def histogram_bucket(value: float) -> int:
+    """Return the smallest power of two that is not below value."""
+    bucket = 1
+    while bucket < value:
+        bucket *= 2
+    return bucket
+
+
+PROTOCOL_VERSIONS = {
+    "3.1": ProtocolVersion.V31,
+    "3.1.1": ProtocolVersion.V311,
+    "5": ProtocolVersion.V5,
+}
+
+
+def subscriptions(topic: Optional[str], qos: int, topics: List[Any], shared_group: Optional[str]) -> List[Tuple[str, int]]:
+    """Return the (topic filter, qos) pairs to subscribe to over one connection."""
+    filters = []
+    if topic:
+        filters.append((f'{topic}/#', qos))
+    for item in topics:
+        if isinstance(item, dict):
+            filters.append((item["topic"], int(item.get("qos", qos))))
+        else:
+            filters.append((item, qos))
+    if shared_group:
+        filters = [(f'$share/{shared_group}/{topic_filter}', topic_qos) for topic_filter, topic_qos in filters]
+    return filters
+
+
+def decode_payload(payload: bytes, payload_format: str) -> Any:
+    """Decode payload, raising ValueError when it is not valid UTF-8 or not valid JSON."""
+    if payload_format == "json":
+        # Both backends accept bytes and reject invalid UTF-8 with a ValueError
+        return json_loads(payload)
+    return payload.decode()
+
+
+def message_entry(message, payload_format: str, forward_parse_errors: bool, stats: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Return the topic, qos, retain flag and decoded payload of message.
+
+    Payloads that cannot be decoded are counted and, unless forward_parse_errors
+    is set, dropped by returning None.
+    """
+    entry = {
+        "topic": str(message.topic),
+        "qos": message.qos,
+        "retain": message.retain,
+    }
+    try:
+        entry["payload"] = decode_payload(message.payload, payload_format)
+    except ValueError as e:
+        stats["parse_errors"] += 1
+        logger.debug("Could not decode payload on %s: %s", entry["topic"], e)
+        if not forward_parse_errors:
+            return None
+        entry["payload"] = message.payload.decode(errors="replace")
+        entry["parse_error"] = str(e)
+    return entry
+
+
+def single_event(entry: Dict[str, Any]) -> Dict[str, Any]:
+    event = {
+        "payload": entry["payload"],
+        "meta": {"topic": entry["topic"], "qos": entry["qos"], "retain": entry["retain"]},
+    }
+    if "parse_error" in entry:
+        event["parse_error"] = entry["parse_error"]
+    return event
+
+
+class MessageBuffer:
+    """Bounded buffer of (received_at, entry) pairs applying an overflow policy when full."""
+
+    def __init__(self, maxsize: int, policy: str, stats: Dict[str, Any]):
+        self.maxsize = maxsize
+        self.policy = policy
+        self.stats = stats
+        self._items = deque()
+        # Buffered messages per topic, so coalescing only scans when it can succeed
+        self._topics = Counter()
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def empty(self) -> bool:
+        return not self._items
+
+    async def put(self, item: Tuple[float, Dict[str, Any]]):
+        topic = item[1]["topic"]
+        if self.policy == "coalesce" and len(self._items) >= self.maxsize and self._topics[topic]:
+            # Replace the latest buffered message on the topic, keeping the topic's messages in order
+            for index in range(len(self._items) - 1, -1, -1):
+                if self._items[index][1]["topic"] == topic:
+                    self._items[index] = item
+                    break
+            self.stats["coalesced"] += 1
+            return
+
+        while len(self._items) >= self.maxsize:
+            if self.policy == "block":
+                self._not_full.clear()
+                await self._not_full.wait()
+                continue
+            self.stats["dropped"] += 1
+            if self.policy == "drop_newest":
+                return
+            self._pop()
+
+        self._items.append(item)
+        self._topics[topic] += 1
+        self._not_empty.set()
+
+    async def get(self) -> Tuple[float, Dict[str, Any]]:
+        while not self._items:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        return self.get_nowait()
+
+    def get_nowait(self) -> Tuple[float, Dict[str, Any]]:
+        item = self._pop()
+        self._not_full.set()
+        return item
+
+    def _pop(self) -> Tuple[float, Dict[str, Any]]:
+        item = self._items.popleft()
+        topic = item[1]["topic"]
+        self._topics[topic] -= 1
+        if not self._topics[topic]:
+            del self._topics[topic]
+        return item
+
+
+async def forward_messages(queue: asyncio.Queue, pending: MessageBuffer, payload_format: str):
+    """Place messages from pending on queue one at a time."""
+    while True:
+        _, entry = await pending.get()
+        if payload_format == "raw" and "parse_error" not in entry:
+            await queue.put(entry["payload"])
+        else:
+            await queue.put(single_event(entry))
+
+
+async def batch_messages(queue: asyncio.Queue, pending: MessageBuffer, max_batch: int, linger: float, stats: Dict[str, Any]):
+    """Place messages from pending on queue in batches of up to max_batch, waiting at most linger seconds."""
+    loop = asyncio.get_running_loop()
+    while True:
+        received_at, entry = await pending.get()
+        batch = [entry]
+        deadline = received_at + linger
+
+        while len(batch) < max_batch:
+            if pending.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    _, entry = await asyncio.wait_for(pending.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                _, entry = pending.get_nowait()
+            batch.append(entry)
+
+        stats["batches"] += 1
+        stats["batch_sizes"][histogram_bucket(len(batch))] += 1
+        stats["latency_ms"][histogram_bucket((loop.time() - received_at) * 1000)] += 1
+        await queue.put({"batch": batch})
+
+
+async def report_stats(stats: Dict[str, Any], interval: int):
+    while True:
+        await asyncio.sleep(interval)
+        logger.info(
+            "Received %d messages (%d parse errors, %d dropped, %d coalesced) in %d batches, batch sizes (<=n: count) %s, latency ms (<=n: count) %s",
+            stats["messages"],
+            stats["parse_errors"],
+            stats["dropped"],
+            stats["coalesced"],
+            stats["batches"],
+            dict(sorted(stats["batch_sizes"].items())),
+            dict(sorted(stats["latency_ms"].items())),
+        )
 
-from asyncio_mqtt import Client
 
 async def main(queue: asyncio.Queue, args: Dict[str, Any]):
-    logger = logging.getLogger()
     topic = args.get("topic")
     host = args.get("host")
+    qos = int(args.get("qos", 0))
+    topics = args.get("topics") or []
+    shared_group = args.get("shared_group")
+    protocol_version = str(args.get("protocol_version") or ("5" if shared_group else "3.1.1"))
+    max_batch = int(args.get("max_batch", 1))
+    linger = int(args.get("linger_ms", 100)) / 1000
+    stats_interval = int(args.get("stats_interval", 60))
+    payload_format = args.get("payload_format", "raw")
+    forward_parse_errors = args.get("forward_parse_errors", False)
+    buffer_size = int(args.get("buffer_size", 10000))
+    overflow_policy = args.get("overflow_policy", "block")
+
+    if payload_format == "json":
+        logger.debug("Parsing JSON payloads with %s", JSON_BACKEND)
+
+    stats = {
+        "messages": 0,
+        "parse_errors": 0,
+        "dropped": 0,
+        "coalesced": 0,
+        "batches": 0,
+        "batch_sizes": Counter(),
+        "latency_ms": Counter(),
+    }
+    tasks = []
+    if stats_interval:
+        tasks.append(asyncio.create_task(report_stats(stats, stats_interval)))
+
+    try:
+        async with Client(host, protocol=PROTOCOL_VERSIONS[protocol_version]) as client:
+            async with client.messages() as messages:
+                await client.subscribe(subscriptions(topic, qos, topics, shared_group))
+
+                # Decouple the broker connection from the rulebook queue so a slow
+                # rulebook only fills the buffer instead of stalling the receive loop
+                loop = asyncio.get_running_loop()
+                pending = MessageBuffer(buffer_size, overflow_policy, stats)
+                if max_batch <= 1:
+                    tasks.append(asyncio.create_task(forward_messages(queue, pending, payload_format)))
+                else:
+                    tasks.append(asyncio.create_task(batch_messages(queue, pending, max_batch, linger, stats)))
 
-    async with Client(host) as client:
-        async with client.messages() as messages:
-            await client.subscribe(f'{topic}/#')
-            async for message in messages:
-                await queue.put(message.payload.decode())
+                async for message in messages:
+                    stats["messages"] += 1
+                    entry = message_entry(message, payload_format, forward_parse_errors, stats)
+                    if entry is not None:
+                        await pending.put((loop.time(), entry))
+    finally:
+        for task in tasks:
+            task.cancel()
 
 if __name__ == "__main__":
     topic = os.environ.get('MQTT_TOPIC')
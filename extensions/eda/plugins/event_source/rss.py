@@ -1,10 +1,17 @@
 import aiohttp
 import asyncio
 import feedparser
+import hashlib
+import heapq
 import logging
 import json
 import os
+import random
+import re
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from typing import List, Dict, Optional, Any
+from urllib.parse import urlsplit
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -14,26 +21,39 @@ module: rss
 short_description: Event-Driven Ansible source plugin for RSS feed events
 description:
     - Poll multiple RSS feeds for new items
-    - Only retrieves items that occurred after the script began executing
+    - Only retrieves items that were not on the feed when the script began executing
+    - New items are recognised by their id (or link) and placed on the queue oldest first
+    - Feeds are polled by a single scheduler that spreads polls over time and limits how many feeds are fetched at once, in total and per host
+    - Feeds are fetched with conditional requests (ETag and Last-Modified) and are only parsed when their content changed
 author: "Colin McNaughton @cloin - https://github.com/cloin"
 options:
     feed_configs:
         description:
             - A list of dictionaries, each representing a configuration for an RSS feed.
             - Each dictionary must have a 'url' key containing the URL of the RSS feed.
-            - Optionally, a 'search' key can be included to filter items based on a search string present in the item's summary.
+            - Optionally, a 'search' key can be included to filter items based on a search string present in the item's summary. It can also be a list of search strings, in which case items matching any of them are kept.
+            - Optionally, a 'search_regex' key can be included with a regular expression, or a list of them, to filter items in the same way.
+            - Optionally, a 'search_fields' key can be provided with the list of item fields searched, out of 'title', 'summary' and 'tags'. Defaults to 'summary'.
+            - Optionally, a 'search_ignore_case' key can be set to True to search case-insensitively.
+            - When searching, the search strings and regular expressions that matched are added as "matched_terms" in each event.
             - Optionally, a 'content_tags' key can be provided to specify the dot-notation path for content tags within each feed item. If found, a new key "content_tags" is added to the dictionary.
             - Optionally, an 'interval' key can be provided to specify the polling interval in seconds for this specific feed. If not provided, the global 'interval' value is used.
             - Optionally, a 'name' key can be provided to specify the name of the feed. This name will be added as "feed_name" in each event.
+            - Optionally, 'seen_limit' and 'stop_at_seen' keys can be provided to override the global values for this specific feed.
+            - Optionally, a 'fields' key can be provided with the list of item fields to keep in each event. All fields are kept when not set.
         required: true
         type: list
         elements: dict
         example:
             - url: "http://example.com/rss1"
-              search: "python"
+              search: ["python", "ansible"]
+              search_regex: "event[- ]driven"
+              search_fields: ["title", "summary"]
+              search_ignore_case: true
               content_tags: "tags.label"
               interval: 30
               name: "Example RSS"
+              fields: ["title", "link", "summary", "tags"]
     interval:
         description:
             - The default interval, in seconds, at which the script polls the feeds. This value is used when an individual 'interval' is not specified in the 'feed_configs'.
@@ -45,6 +65,42 @@ options:
         required: false
         default: False
         type: bool
+    seen_limit:
+        description:
+            - The number of most recently seen items remembered per feed to recognise new items. At least as many items as the feed currently lists are always remembered.
+        required: false
+        default: 1000
+    stop_at_seen:
+        description:
+            - When True, stop looking for new items at the first item that was already seen. Feeds list their newest items first, so the remaining items are older. Disable for feeds that are not ordered by date.
+        required: false
+        default: True
+        type: bool
+    max_concurrency:
+        description:
+            - The maximum number of feeds fetched at the same time.
+        required: false
+        default: 20
+    max_per_host:
+        description:
+            - The maximum number of feeds fetched at the same time from a single host.
+        required: false
+        default: 2
+    jitter:
+        description:
+            - Fraction of a feed's interval by which each poll is randomly moved earlier or later, so feeds sharing an interval do not poll in lockstep.
+        required: false
+        default: 0.1
+    parser:
+        description:
+            - Where feeds are parsed so that parsing does not block the event loop. C(thread) uses a thread pool, C(process) uses a process pool and C(inline) parses on the event loop.
+        required: false
+        default: thread
+        choices: ["thread", "process", "inline"]
+    parser_workers:
+        description:
+            - Number of workers in the parser pool. Defaults to the pool's own default.
+        required: false
 '''
 
 EXAMPLES = r'''
@@ -121,67 +177,303 @@ def get_nested_value(dictionary: Dict[str, Any], keys: List[str]) -> Any:
         dictionary = dictionary.get(key)
     return dictionary
 
-async def fetch_rss_feed(session: aiohttp.ClientSession, feed_url: str) -> str:
+def new_feed_state() -> Dict[str, Any]:
+    return {
+        "etag": None,
+        "last_modified": None,
+        "hash": None,
+        "polls": 0,
+        "not_modified": 0,
+        "unchanged": 0,
+    }
+
+async def fetch_rss_feed(session: aiohttp.ClientSession, feed_url: str, state: Dict[str, Any]) -> Optional[str]:
+    """Fetch a feed, returning None when it has not changed since the last fetch and "" on errors."""
+    headers = {}
+    if state["etag"]:
+        headers["If-None-Match"] = state["etag"]
+    if state["last_modified"]:
+        headers["If-Modified-Since"] = state["last_modified"]
+
+    state["polls"] += 1
     try:
-        async with session.get(feed_url) as response:
-            if response.status == 200:
-                return await response.text()
-            else:
+        async with session.get(feed_url, headers=headers) as response:
+            if response.status == 304:
+                state["not_modified"] += 1
+                return None
+            if response.status != 200:
                 logger.error(f"Failed to fetch {feed_url}, status: {response.status}")
                 return ""
+
+            state["etag"] = response.headers.get("ETag")
+            state["last_modified"] = response.headers.get("Last-Modified")
+            body = await response.read()
+
+            # Servers without validators still send the same body when nothing changed
+            content_hash = hashlib.sha1(body).digest()
+            if content_hash == state["hash"]:
+                state["unchanged"] += 1
+                return None
+            state["hash"] = content_hash
+            return await response.text()
     except Exception as e:
         logger.error(f"Error fetching {feed_url}: {e}")
         return ""
 
-async def poll_feed(queue: asyncio.Queue, session: aiohttp.ClientSession, feed_config: Dict[str, Any], default_interval: int, most_recent_item: bool):
-    feed_url = feed_config.get('url')
-    search_string = feed_config.get('search')
+def select_fields(entry: Dict[str, Any], fields: List[str]) -> Dict[str, Any]:
+    selected = {}
+    for field in fields:
+        # Look fields up by key so feedparser's aliases still resolve
+        try:
+            selected[field] = entry[field]
+        except KeyError:
+            pass
+    return selected
+
+def feed_entries(parsed: Dict[str, Any], fields: Optional[List[str]]) -> List[Dict[str, Any]]:
+    """Return the entries of a parsed feed, limited to fields."""
+    entries = parsed.entries
+    if fields:
+        entries = [select_fields(entry, fields) for entry in entries]
+    return entries
+
+def entry_key(entry: Dict[str, Any]) -> bytes:
+    """Return a compact hash identifying an entry by its id, falling back to its link or title."""
+    identity = entry.get('id') or entry.get('link') or entry.get('title') or ''
+    return hashlib.blake2b(identity.encode(), digest_size=8).digest()
+
+def new_entries(entries: List[Dict[str, Any]], seen: "OrderedDict[bytes, None]", seen_limit: int, stop_at_seen: bool) -> List[Dict[str, Any]]:
+    """Return the entries not in seen, oldest first, and remember them in seen.
+
+    Feeds list their newest entries first, so with stop_at_seen the scan ends
+    at the first entry that was already seen. seen is kept oldest first so
+    the oldest entries are forgotten first, and never shrinks below the
+    number of entries the feed currently lists.
+    """
+    found = {}
+    still_listed = []
+    for entry in entries:
+        key = entry_key(entry)
+        if key in seen:
+            still_listed.append(key)
+            if stop_at_seen:
+                break
+            continue
+        found.setdefault(key, entry)
+
+    # Emit in chronological order, trusting the feed order when entries aren't all dated
+    dates = [entry.get('published_parsed') or entry.get('updated_parsed') for entry in found.values()]
+    if all(dates):
+        ordered = [pair for _, pair in sorted(zip(dates, found.items()), key=lambda item: item[0])]
+    else:
+        ordered = list(found.items())[::-1]
+
+    for key in reversed(still_listed):
+        seen.move_to_end(key)
+    for key, _ in ordered:
+        seen[key] = None
+    while len(seen) > max(seen_limit, len(entries)):
+        seen.popitem(last=False)
+
+    return [entry for _, entry in ordered]
+
+class Matcher:
+    """Search strings and regular expressions compiled once.
+
+    All terms are combined into a single regular expression, so one scan of
+    a field rejects entries that match nothing. Entries that do match are
+    tested against each term on its own, as the combined expression only
+    reports one term at each position and its matches never overlap.
+    """
+
+    def __init__(self, strings: List[str], regexes: List[str], fields: List[str], ignore_case: bool):
+        self.fields = fields
+        self.terms = strings + regexes
+        flags = re.IGNORECASE if ignore_case else 0
+        self.term_patterns = [re.compile(re.escape(term), flags) for term in strings] + [re.compile(term, flags) for term in regexes]
+        self.pattern = re.compile("|".join(f"(?:{pattern.pattern})" for pattern in self.term_patterns), flags)
+
+    def field_text(self, entry: Dict[str, Any], field: str) -> str:
+        if field == 'tags':
+            return " ".join(tag.get('term') or '' for tag in entry.get('tags') or [])
+        return entry.get(field) or ''
+
+    def match(self, entry: Dict[str, Any]) -> List[str]:
+        """Return the terms found in the entry's searched fields, in the order they were first found."""
+        texts = [self.field_text(entry, field) for field in self.fields]
+        if not any(self.pattern.search(text) for text in texts):
+            return []
+        found = {}
+        for index, term_pattern in enumerate(self.term_patterns):
+            for field_index, text in enumerate(texts):
+                first = term_pattern.search(text)
+                if first:
+                    found[index] = (field_index, first.start(), index)
+                    break
+        return [self.terms[index] for index in sorted(found, key=found.get)]
+
+def as_list(value: Any) -> List[str]:
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [value]
+    return list(value)
+
+def new_matcher(feed_config: Dict[str, Any]) -> Optional[Matcher]:
+    """Compile the feed's search settings, returning None when items are not filtered."""
+    # An empty search string matches every item, the same as no search at all
+    strings = [term for term in as_list(feed_config.get('search')) if term]
+    regexes = [term for term in as_list(feed_config.get('search_regex')) if term]
+    if not strings and not regexes:
+        return None
+    fields = as_list(feed_config.get('search_fields')) or ['summary']
+    return Matcher(strings, regexes, fields, bool(feed_config.get('search_ignore_case', False)))
+
+async def put_entry(queue: asyncio.Queue, entry: Dict[str, Any], matcher: Optional[Matcher], content_tags_keys: List[str], feed_name: str):
+    matched_terms = matcher.match(entry) if matcher else None
+    if matched_terms is None or matched_terms:
+        if matched_terms:
+            entry['matched_terms'] = matched_terms
+        content_tags = get_nested_value(entry, content_tags_keys) if content_tags_keys else None
+        if content_tags is not None:
+            entry['content_tags'] = content_tags
+        entry['feed_name'] = feed_name
+        await queue.put(entry)
+
+def new_feed(feed_config: Dict[str, Any], default_interval: int, seen_limit: int, stop_at_seen: bool) -> Dict[str, Any]:
+    """Return the settings and polling state of one feed."""
     content_tags_path = feed_config.get('content_tags')
     content_tags_keys = content_tags_path.split('.') if content_tags_path else []
-    interval = feed_config.get('interval') or default_interval
-    feed_name = feed_config.get('name', '')
-    last_updated = None
-    first_poll = True
+    matcher = new_matcher(feed_config)
+    fields = feed_config.get('fields')
+    if fields:
+        # Keep the fields used for searching, tagging and recognising seen entries as well
+        search_fields = matcher.fields if matcher else []
+        fields = list(dict.fromkeys(fields + search_fields + ['id', 'link', 'title', 'published_parsed', 'updated_parsed'] + content_tags_keys[:1]))
+    feed = new_feed_state()
+    feed.update({
+        "url": feed_config.get('url'),
+        "host": urlsplit(feed_config.get('url')).hostname,
+        "matcher": matcher,
+        "content_tags_keys": content_tags_keys,
+        "fields": fields,
+        "interval": float(feed_config.get('interval') or default_interval),
+        "name": feed_config.get('name', ''),
+        "seen_limit": int(feed_config.get('seen_limit') or seen_limit),
+        "stop_at_seen": feed_config.get('stop_at_seen', stop_at_seen),
+        "seen": OrderedDict(),
+        "first_poll": True,
+        "overlapped": 0,
+    })
+    return feed
 
-    while True:
-        try:
-            feed_data = await fetch_rss_feed(session, feed_url)
-            if feed_data:
-                feed = feedparser.parse(feed_data)
-
-                if first_poll and most_recent_item and feed.entries:
-                    entry = feed.entries[0]
-                    if search_string is None or search_string in entry.summary:
-                        content_tags = get_nested_value(entry, content_tags_keys) if content_tags_keys else None
-                        if content_tags is not None:
-                            entry['content_tags'] = content_tags
-                        entry['feed_name'] = feed_name
-                        await queue.put(entry)
-                    first_poll = False
-                elif last_updated:
-                    for entry in feed.entries:
-                        if entry.updated_parsed > last_updated and (search_string is None or search_string in entry.summary):
-                            content_tags = get_nested_value(entry, content_tags_keys) if content_tags_keys else None
-                            if content_tags is not None:
-                                entry['content_tags'] = content_tags
-                            entry['feed_name'] = feed_name
-                            await queue.put(entry)
-
-                last_updated = feed.feed.updated_parsed if hasattr(feed.feed, 'updated_parsed') else None
+async def poll_feed(queue: asyncio.Queue, session: aiohttp.ClientSession, feed: Dict[str, Any], most_recent_item: bool, executor: Optional[Executor]):
+    """Fetch a feed once and place its new items on the queue."""
+    feed_url = feed["url"]
+    try:
+        feed_data = await fetch_rss_feed(session, feed_url, feed)
+        skipped = feed["not_modified"] + feed["unchanged"]
+        logger.debug(
+            "%s: %d polls, %d not modified, %d unchanged (%.0f%% not parsed), %d skipped while in flight",
+            feed_url, feed["polls"], feed["not_modified"], feed["unchanged"], 100 * skipped / feed["polls"], feed["overlapped"],
+        )
+        if feed_data:
+            if executor is None:
+                parsed = feedparser.parse(feed_data)
             else:
-                logger.error(f"No data fetched for {feed_url}")
-        except Exception as e:
-            logger.error(f"Error polling {feed_url}: {e}")
-        await asyncio.sleep(interval)
+                # ansible-rulebook loads this plugin with runpy, so functions defined
+                # here can't be pickled for a process pool. Only feedparser runs there.
+                loop = asyncio.get_running_loop()
+                parsed = await loop.run_in_executor(executor, feedparser.parse, feed_data)
+            entries = feed_entries(parsed, feed["fields"])
+
+            if feed["first_poll"]:
+                # Everything already on the feed is seen, apart from the optional most recent item
+                new_entries(entries, feed["seen"], feed["seen_limit"], stop_at_seen=False)
+                if most_recent_item and entries:
+                    await put_entry(queue, entries[0], feed["matcher"], feed["content_tags_keys"], feed["name"])
+                feed["first_poll"] = False
+            else:
+                for entry in new_entries(entries, feed["seen"], feed["seen_limit"], feed["stop_at_seen"]):
+                    await put_entry(queue, entry, feed["matcher"], feed["content_tags_keys"], feed["name"])
+        elif feed_data is not None:
+            logger.error(f"No data fetched for {feed_url}")
+    except Exception as e:
+        logger.error(f"Error polling {feed_url}: {e}")
+
+async def schedule_feeds(queue: asyncio.Queue, session: aiohttp.ClientSession, feeds: List[Dict[str, Any]], most_recent_item: bool, executor: Optional[Executor], max_concurrency: int, max_per_host: int, jitter: float):
+    """Poll every feed when it is due, from a single min-heap of due times.
+
+    Each next due time is jittered so feeds sharing an interval drift apart,
+    fetches are limited globally and per host, and a feed whose previous
+    fetch is still running skips its turn.
+    """
+    loop = asyncio.get_running_loop()
+    global_limit = asyncio.Semaphore(max_concurrency)
+    host_limits: Dict[str, asyncio.Semaphore] = {}
+    in_flight = set()
+    running = set()
+
+    async def run(index: int):
+        feed = feeds[index]
+        host_limit = host_limits.setdefault(feed["host"], asyncio.Semaphore(max_per_host))
+        try:
+            # Wait for the host first so a busy host can't hold global slots
+            async with host_limit, global_limit:
+                await poll_feed(queue, session, feed, most_recent_item, executor)
+        finally:
+            in_flight.discard(index)
+
+    now = loop.time()
+    heap = [(now, index) for index in range(len(feeds))]
+    heapq.heapify(heap)
+
+    while heap:
+        due, index = heapq.heappop(heap)
+        # Always yield, so an interval of 0 can't keep the polls themselves from running
+        await asyncio.sleep(max(due - loop.time(), 0))
+
+        feed = feeds[index]
+        next_due = due + feed["interval"] * (1 + random.uniform(-jitter, jitter))
+        heapq.heappush(heap, (max(next_due, loop.time()), index))
+
+        if index in in_flight:
+            feed["overlapped"] += 1
+            continue
+        in_flight.add(index)
+        task = asyncio.create_task(run(index))
+        running.add(task)
+        task.add_done_callback(running.discard)
 
 async def main(queue: asyncio.Queue, args: Dict[str, Any]):
     default_interval = int(args.get("interval", 7200))
     feed_configs = args.get("feed_configs", [])
     most_recent_item = args.get("most_recent_item", False)
+    parser = args.get("parser", "thread")
+    parser_workers = args.get("parser_workers")
+    parser_workers = int(parser_workers) if parser_workers else None
+    seen_limit = int(args.get("seen_limit", 1000))
+    stop_at_seen = args.get("stop_at_seen", True)
+    max_concurrency = int(args.get("max_concurrency", 20))
+    max_per_host = int(args.get("max_per_host", 2))
+    jitter = float(args.get("jitter", 0.1))
 
-    async with aiohttp.ClientSession() as session:
-        tasks = [poll_feed(queue, session, config, default_interval, most_recent_item) for config in feed_configs]
-        await asyncio.gather(*tasks)
+    feeds = [new_feed(config, default_interval, seen_limit, stop_at_seen) for config in feed_configs]
+
+    # Parsing large feeds is CPU bound, so keep it off the event loop
+    executor = None
+    if parser == "thread":
+        executor = ThreadPoolExecutor(max_workers=parser_workers, thread_name_prefix="rss-parser")
+    elif parser == "process":
+        executor = ProcessPoolExecutor(max_workers=parser_workers)
+
+    try:
+        connector = aiohttp.TCPConnector(limit=max_concurrency, limit_per_host=max_per_host)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            await schedule_feeds(queue, session, feeds, most_recent_item, executor, max_concurrency, max_per_host, jitter)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
 
 if __name__ == "__main__":
     FEED_CONFIGS = os.getenv("FEED_CONFIGS", '[{"url": "http://example.com/rss"}]')
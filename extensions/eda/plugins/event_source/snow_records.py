@@ -3,8 +3,11 @@ DOCUMENTATION = r'''
 module: snow_records
 short_description: event-driven-ansible source plugin for ServiceNow records
 description:
-    - Poll ServiceNow API for new records in a table
-    - Only retrieves records created after the script began executing
+    - Poll ServiceNow API for new records in one or more tables
+    - Each record is tagged with the table it came from in its table key
+    - All tables are polled over one pool of connections to the instance
+    - Only retrieves records created or updated after the script began executing
+    - Each poll only asks ServiceNow for records updated since the last record seen, oldest first
     - This script can be tested outside of ansible-rulebook by specifying environment variables for SN_HOST, SN_USERNAME, SN_PASSWORD, SN_TABLE
 author: "Colin McNaughton (@cloin)"
 options:
@@ -23,7 +26,13 @@ options:
     table:
         description:
             - ServiceNow table to watch for new records created
-        required: true
+            - Either table or tables is required
+        required: false
+    tables:
+        description:
+            - ServiceNow tables to watch, each either a table name or a dict with table and optionally its own query, fields, exclude_reference_link and interval
+            - Options not set for a table fall back to the options of the source
+        required: false
     query:
         description:
             - Records to query
@@ -34,6 +43,28 @@ options:
             - Seconds to wait before performing another query
         required: false
         default: 5
+    fields:
+        description:
+            - Fields to return for each record, as a list or a comma separated string
+            - sys_id and sys_updated_on are always returned
+            - All fields are returned by default
+        required: false
+    exclude_reference_link:
+        description:
+            - Leave the API links out of reference fields
+        required: false
+        default: false
+    page_size:
+        description:
+            - Maximum number of records requested at once
+            - When more records match, the remaining pages are fetched concurrently and emitted in order
+        required: false
+        default: 1000
+    max_concurrency:
+        description:
+            - Maximum number of requests to the instance at the same time, across all tables
+        required: false
+        default: 4
 notes:
     - This is currently only capable of basic authentication and is used so far only for demo purposes
 '''
@@ -53,14 +84,195 @@ EXAMPLES = r'''
         condition: event.sys_id is defined
         action:
         debug:
+
+- name: Watch several tables
+    hosts: localhost
+    sources:
+    - cloin.eda.snow_records:
+        instance: https://dev-012345.service-now.com
+        username: ansible
+        password: ansible
+        fields: number,short_description,state
+        tables:
+          - incident
+          - table: change_request
+            interval: 30
+          - table: sc_req_item
+            query: active=true
+            fields: number,stage
+    rules:
+    - name: New incident
+        condition: event.table == "incident"
+        action:
+        debug:
 '''
 
 import asyncio
+import heapq
 import time
 import os
-from typing import Any, Dict
+from collections import deque
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Tuple
 import aiohttp
 
+def watermark_query(query: str, watermark: str) -> str:
+    """Add the watermark clause and ordering to an encoded query."""
+    clauses = [query] if query else []
+    clauses.append(f'sys_updated_on>={watermark}')
+    clauses.append('ORDERBYsys_updated_on')
+    return '^'.join(clauses)
+
+def is_new_record(record: Dict[str, Any], watermark: str, boundary: Set[str]) -> bool:
+    """Return whether a record is past the watermark, ignoring records already seen at the watermark."""
+    updated_on = record['sys_updated_on']
+    if updated_on < watermark:
+        return False
+    return updated_on > watermark or record['sys_id'] not in boundary
+
+def as_list(value: Any) -> List[str]:
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [field.strip() for field in value.split(',') if field.strip()]
+    return list(value)
+
+def base_params(fields: List[str], exclude_reference_link: bool) -> Dict[str, str]:
+    """Return the query parameters sent with every request for a table."""
+    params = {}
+    if fields:
+        # The watermark needs sys_id and sys_updated_on whatever else is selected
+        params['sysparm_fields'] = ','.join(dict.fromkeys(fields + ['sys_id', 'sys_updated_on']))
+    if exclude_reference_link:
+        params['sysparm_exclude_reference_link'] = 'true'
+    return params
+
+async def fetch_page(session: aiohttp.ClientSession, url: str, params: Dict[str, str], auth: aiohttp.BasicAuth, offset: int, limit: int, semaphore: asyncio.Semaphore) -> Optional[Tuple[List[Dict[str, Any]], int]]:
+    """Fetch one page of records, returning them with the total number of matching records, or None on errors."""
+    params = dict(params, sysparm_offset=str(offset), sysparm_limit=str(limit))
+    async with semaphore:
+        async with session.get(url, params=params, auth=auth) as resp:
+            if resp.status != 200:
+                print(f'Error {resp.status}')
+                return None
+            records = (await resp.json())['result']
+            total = int(resp.headers.get('X-Total-Count', offset + len(records)))
+            return records, total
+
+async def fetch_records(session: aiohttp.ClientSession, url: str, params: Dict[str, str], auth: aiohttp.BasicAuth, page_size: int, semaphore: asyncio.Semaphore, max_concurrency: int) -> AsyncIterator[List[Dict[str, Any]]]:
+    """Yield every page of matching records in order.
+
+    The first page reports how many records match, then the remaining pages
+    are fetched ahead of the one being emitted, at most max_concurrency at a
+    time. Fetching stops at the first failed page, so no records are skipped:
+    the rest are picked up from the watermark on the next poll.
+
+    Records updated during a poll move to the end of the results and shift
+    every later record back, so each page also fetches the last record of
+    the page before it. If that record changed, the results shifted between
+    the two requests and the poll stops there, to carry on from the
+    watermark next time instead of skipping the record that moved pages.
+    """
+    page = await fetch_page(session, url, params, auth, 0, page_size, semaphore)
+    if page is None:
+        return
+    records, total = page
+    yield records
+    if not records:
+        return
+    last_id = records[-1]['sys_id']
+
+    offsets = iter(range(page_size, total, page_size))
+    pending = deque()
+    try:
+        while True:
+            while len(pending) < max_concurrency:
+                offset = next(offsets, None)
+                if offset is None:
+                    break
+                pending.append(asyncio.ensure_future(fetch_page(session, url, params, auth, offset - 1, page_size + 1, semaphore)))
+            if not pending:
+                return
+            page = await pending.popleft()
+            if page is None:
+                return
+            records = page[0]
+            if not records or records[0]['sys_id'] != last_id:
+                return
+            yield records[1:]
+            last_id = records[-1]['sys_id']
+    finally:
+        for task in pending:
+            task.cancel()
+
+def new_table(table_config: Dict[str, Any], defaults: Dict[str, Any], instance: str, watermark: str) -> Dict[str, Any]:
+    """Return the settings and polling state of one table, falling back to the source's options."""
+    table = table_config['table']
+    fields = as_list(table_config.get('fields', defaults['fields']))
+    exclude_reference_link = bool(table_config.get('exclude_reference_link', defaults['exclude_reference_link']))
+    return {
+        "table": table,
+        "url": f'{instance}/api/now/table/{table}',
+        "query": table_config.get('query', defaults['query']),
+        "params": base_params(fields, exclude_reference_link),
+        "interval": float(defaults['interval'] if table_config.get('interval') is None else table_config['interval']),
+        # Only records updated at or after the watermark are requested. The sys_ids
+        # already emitted at exactly the watermark are kept so they aren't emitted twice.
+        "watermark": watermark,
+        "boundary": set(),
+    }
+
+async def poll_table(queue: asyncio.Queue, session: aiohttp.ClientSession, auth: aiohttp.BasicAuth, table: Dict[str, Any], page_size: int, semaphore: asyncio.Semaphore, max_concurrency: int):
+    """Fetch the records of a table updated since its watermark and place them on the queue."""
+    params = dict(table["params"], sysparm_query=watermark_query(table["query"], table["watermark"]))
+    try:
+        async for records in fetch_records(session, table["url"], params, auth, page_size, semaphore, max_concurrency):
+            for record in records:
+
+                if is_new_record(record, table["watermark"], table["boundary"]):
+                    if record['sys_updated_on'] > table["watermark"]:
+                        table["watermark"] = record['sys_updated_on']
+                        table["boundary"] = set()
+                    table["boundary"].add(record['sys_id'])
+                    record['table'] = table["table"]
+                    await queue.put(record)
+    except Exception as e:
+        print(f'Error polling {table["table"]}: {e}')
+
+async def schedule_tables(queue: asyncio.Queue, session: aiohttp.ClientSession, auth: aiohttp.BasicAuth, tables: List[Dict[str, Any]], page_size: int, max_concurrency: int):
+    """Poll every table when it is due, from a single min-heap of due times.
+
+    All tables share one limit on concurrent requests, and a table whose
+    previous poll is still running skips its turn.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    in_flight = set()
+    running = set()
+
+    async def run(index: int):
+        try:
+            await poll_table(queue, session, auth, tables[index], page_size, semaphore, max_concurrency)
+        finally:
+            in_flight.discard(index)
+
+    now = loop.time()
+    heap = [(now, index) for index in range(len(tables))]
+    heapq.heapify(heap)
+
+    while heap:
+        due, index = heapq.heappop(heap)
+        # Always yield, so an interval of 0 can't keep the polls themselves from running
+        await asyncio.sleep(max(due - loop.time(), 0))
+
+        heapq.heappush(heap, (max(due + tables[index]["interval"], loop.time()), index))
+
+        if index in in_flight:
+            continue
+        in_flight.add(index)
+        task = asyncio.create_task(run(index))
+        running.add(task)
+        task.add_done_callback(running.discard)
+
 # Entrypoint from ansible-rulebook
 async def main(queue: asyncio.Queue, args: Dict[str, Any]):
 
@@ -68,28 +280,28 @@ async def main(queue: asyncio.Queue, args: Dict[str, Any]):
     username = args.get("username")
     password = args.get("password")
     table    = args.get("table")
-    query    = args.get("query", "sys_created_onONToday@javascript:gs.beginningOfToday()@javascript:gs.endOfToday()")
-    interval = int(args.get("interval", 5))
+    tables   = args.get("tables") or [{"table": table}]
+    defaults = {
+        "query": args.get("query", "sys_created_onONToday@javascript:gs.beginningOfToday()@javascript:gs.endOfToday()"),
+        "interval": float(args.get("interval", 5)),
+        "fields": args.get("fields"),
+        "exclude_reference_link": args.get("exclude_reference_link", False),
+    }
+    page_size = int(args.get("page_size", 1000))
+    max_concurrency = int(args.get("max_concurrency", 4))
 
     start_time = time.time()
-    start_time_str = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(start_time))
-    printed_records = set()
-    async with aiohttp.ClientSession() as session:
-        auth = aiohttp.BasicAuth(login=username, password=password)
-        while True:
-            async with session.get(f'{instance}/api/now/table/{table}?sysparm_query={query}', auth=auth) as resp:
-                if resp.status == 200:
-
-                    records = await resp.json()
-                    for record in records['result']:
+    watermark = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(start_time))
+    tables = [
+        new_table({"table": table_config} if isinstance(table_config, str) else table_config, defaults, instance, watermark)
+        for table_config in tables
+    ]
 
-                        if record['sys_updated_on'] > start_time_str and record['sys_id'] not in printed_records:
-                            printed_records.add(record['sys_id'])
-                            await queue.put(record)
-
-                else:
-                    print(f'Error {resp.status}')
-            await asyncio.sleep(interval)
+    # Every table is on the same instance, so one small pool of connections serves them all
+    connector = aiohttp.TCPConnector(limit=max_concurrency, limit_per_host=max_concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        auth = aiohttp.BasicAuth(login=username, password=password)
+        await schedule_tables(queue, session, auth, tables, page_size, max_concurrency)
 
 if __name__ == "__main__":
     instance = os.environ.get('SN_HOST')